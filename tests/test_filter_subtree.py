@@ -0,0 +1,73 @@
+import json
+import os
+import random
+import unittest
+
+from utils.taxonomy_cache import TaxonomyCache
+
+
+def _make_tree(seed: int = 1, n_genera: int = 40) -> dict:
+    """Build a class -> family -> genus -> species tree with some genus-level leaves."""
+    rng = random.Random(seed)
+    next_id = iter(range(1000, 10 ** 6))
+
+    def node(rank, children=None):
+        taxon_id = next(next_id)
+        return {"id": taxon_id, "name": f"{rank}-{taxon_id}", "rank": rank,
+                "common_name": "", "children": children or []}
+
+    families = [node("family") for _ in range(n_genera // 4)]
+    for _ in range(n_genera):
+        # Leave some genera without species, as genus-level observations do
+        species = [node("species") for _ in range(rng.choice([0, 1, 3, 8]))]
+        rng.choice(families)["children"].append(node("genus", species))
+    return node("class", families)
+
+
+def _species_ids(tree: dict) -> list:
+    ids, stack = [], [tree]
+    while stack:
+        current = stack.pop()
+        if current["rank"] == "species":
+            ids.append(current["id"])
+        stack.extend(current["children"])
+    return ids
+
+
+@unittest.skipUnless(os.environ.get("DATABASE_URL"), "DATABASE_URL is not set")
+class FilterSubtreeTest(unittest.TestCase):
+    """filter_subtree must prune exactly like TaxonomyCache._filter_tree_for_species."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.cache = TaxonomyCache()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.cache.conn.close()
+
+    def _filter_in_db(self, tree: dict, ids: list):
+        with self.cache.conn.cursor() as cur:
+            cur.execute("SELECT filter_subtree(%s::JSONB, %s)", (json.dumps(tree), ids))
+            return cur.fetchone()[0]
+
+    def test_matches_python_filter(self):
+        tree = _make_tree()
+        all_species = _species_ids(tree)
+        rng = random.Random(2)
+        for size in (1, 5, len(all_species) // 2, len(all_species)):
+            ids = sorted(rng.sample(all_species, size))
+            with self.subTest(size=size):
+                self.assertEqual(
+                    self._filter_in_db(tree, ids),
+                    self.cache._filter_tree_for_species(tree, set(ids)),
+                )
+
+    def test_no_matching_species(self):
+        tree = _make_tree()
+        self.assertIsNone(self._filter_in_db(tree, [1]))
+        self.assertIsNone(self.cache._filter_tree_for_species(tree, {1}))
+
+
+if __name__ == "__main__":
+    unittest.main()
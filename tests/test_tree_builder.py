@@ -0,0 +1,122 @@
+import random
+import unittest
+
+import numpy as np
+
+from utils.tree_builder import TreeBuilder
+
+
+def _make_taxa(seed: int = 1) -> list:
+    """Taxa records with mixed string/list ancestor_ids, repeated names and a shuffled order."""
+    rng = random.Random(seed)
+    taxa = [{"taxon_id": 48460, "name": "Life", "rank": "stateofmatter", "ancestor_ids": []}]
+    next_id = iter(range(1000, 10 ** 6))
+
+    def add(rank, name, ancestors):
+        taxon_id = next(next_id)
+        ancestor_ids = ancestors + [taxon_id]
+        taxa.append({
+            "taxon_id": taxon_id,
+            "name": name,
+            "rank": rank,
+            "common_name": f"common {name}" if rng.random() < 0.5 else "",
+            # The taxa table hands back either form
+            "ancestor_ids": str(ancestor_ids[:-1]) if rng.random() < 0.5 else ancestor_ids[:-1],
+        })
+        return ancestor_ids
+
+    kingdom = add("kingdom", "Animalia", [48460])
+    for c in range(3):
+        klass = add("class", f"Class{c}", kingdom)
+        for f in range(3):
+            # Family and genus names repeat across branches
+            family = add("family", f"Family{f % 2}", klass)
+            for g in range(rng.randint(1, 3)):
+                genus = add("genus", "Genus", family)
+                for s in range(rng.randint(0, 4)):
+                    add("species", f"Genus species{s % 2}", genus)
+    # An unknown rank, which sorts after the known ones
+    add("subphylum", "Zoa", kingdom)
+    rng.shuffle(taxa)
+    return taxa
+
+
+def _recursive_layout(nodes: dict, edges: np.ndarray) -> np.ndarray:
+    """The original recursive create_plotly_tree layout, as (x, y) per node."""
+    graph = {i: [] for i in range(len(nodes["ids"]))}
+    for parent, child in edges.tolist():
+        graph[parent].append(child)
+    pos = {}
+
+    def leaf_count(node_id):
+        children = graph[node_id]
+        if not children:
+            return 1
+        return sum(leaf_count(child) for child in children)
+
+    def place(node_id, x=0, y_start=0, vertical_spacing=1):
+        children = graph[node_id]
+        if not children:
+            pos[node_id] = (x, y_start)
+            return y_start + vertical_spacing
+        current_y = y_start
+        child_ys = []
+        for child in children:
+            current_y = place(child, x + 1, current_y, vertical_spacing)
+            child_ys.append(pos[child][1])
+        pos[node_id] = (x, sum(child_ys) / len(child_ys))
+        return current_y
+
+    place(0, vertical_spacing=4.0 / (leaf_count(0) + 1))
+    return np.array([pos[i] for i in range(len(pos))])
+
+
+class BuildPlotArraysTest(unittest.TestCase):
+    """build_plot_arrays must match create_tree_structure(build_taxonomy_tree(...))."""
+
+    def setUp(self):
+        self.taxa = _make_taxa()
+
+    def test_matches_nested_tree_path(self):
+        nodes, edges = TreeBuilder._build_plot_arrays(self.taxa)
+        tree_nodes, tree_edges = TreeBuilder._build_tree_structure(
+            TreeBuilder.build_taxonomy_tree(self.taxa))
+        self.assertEqual(nodes.keys(), tree_nodes.keys())
+        for key in nodes:
+            with self.subTest(key=key):
+                np.testing.assert_array_equal(nodes[key], tree_nodes[key])
+        np.testing.assert_array_equal(edges, tree_edges)
+
+    def test_same_taxon_under_two_parents(self):
+        ranks = {1: "kingdom", 2: "phylum", 3: "class", 5: "genus", 10: "species", 11: "species"}
+        ancestors = {1: [], 2: [1], 3: [1, 2], 5: [1, 2, 3], 10: [1, 3, 5], 11: [1, 2, 3, 5]}
+        taxa = [{"taxon_id": i, "name": f"t{i}", "rank": ranks[i], "ancestor_ids": ancestors[i]}
+                for i in ancestors]
+        nodes, edges = TreeBuilder._build_plot_arrays(taxa)
+        tree_nodes, tree_edges = TreeBuilder._build_tree_structure(TreeBuilder.build_taxonomy_tree(taxa))
+        np.testing.assert_array_equal(nodes["ids"], tree_nodes["ids"])
+        np.testing.assert_array_equal(edges, tree_edges)
+        # Life > K > (P > C > G > 11, C > G > 10)
+        np.testing.assert_array_equal(nodes["ids"], [48460, 1, 2, 3, 5, 11, 3, 5, 10])
+
+    def test_positions_match_recursive_layout(self):
+        nodes, edges = TreeBuilder.build_plot_arrays(self.taxa)
+        expected = _recursive_layout(nodes, edges)
+        fig = TreeBuilder._plot_tree_arrays(nodes, edges)
+        is_species = nodes["ranks"] == "species"
+        for trace, mask in ((fig.data[1], ~is_species), (fig.data[2], is_species)):
+            np.testing.assert_allclose(trace.x, expected[mask, 0], atol=1e-5)
+            np.testing.assert_allclose(trace.y, expected[mask, 1], atol=1e-5)
+
+
+class CollectAllTaxaIdsTest(unittest.TestCase):
+    def test_accepts_builder_output(self):
+        taxa = _make_taxa()
+        tree = TreeBuilder.build_taxonomy_tree(taxa)
+        expected = {t["taxon_id"] for t in taxa}
+        self.assertEqual(TreeBuilder.collect_all_taxa_ids(tree), expected)
+        self.assertEqual(TreeBuilder.collect_all_taxa_ids(tree[0]), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
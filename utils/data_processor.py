@@ -2,7 +2,7 @@ import pandas as pd
 from typing import List, Dict, Optional, Union, Any, Set, Tuple
 from utils.taxonomy_cache import TaxonomyCache
 from utils.database import Database
-from utils.data_utils import normalize_ancestors
+from utils.data_utils import RANK_ORDER, normalize_ancestors, parse_ancestor_ids
 from utils.inat_api import INaturalistAPI  # Import INaturalistAPI directly
 
 class DataProcessor:
@@ -82,7 +82,7 @@ class DataProcessor:
                 if taxon.get('ancestor_ids'):
                     if isinstance(taxon['ancestor_ids'], str):
                         try:
-                            ancestor_ids = eval(taxon['ancestor_ids'])
+                            ancestor_ids = parse_ancestor_ids(taxon['ancestor_ids'])
                         except Exception as e:
                             print(f"Could not parse ancestor_ids string: {taxon['ancestor_ids']} -- {e}")
                     else:
@@ -213,17 +213,26 @@ class DataProcessor:
             "name": "Life",
             "rank": "stateofmatter",
             "common_name": "Life",
-            "children": {}
+            "children": []
         }
         node_map = {48460: tree}  # Global map: taxon_id -> node
+        linked = set()  # (parent_id, child_id) pairs already in a children list
 
         db = Database.get_instance()
 
+        # Resolve every chain first (fetching missing taxa from the API), then
+        # load all the records they reference in one streamed query.
+        chains = []
         for species_id in species_ids:
             print(f"\nProcessing species {species_id}")
             # Get the full ancestor chain for this species
             chain = DataProcessor.get_full_ancestor_chain(species_id)
             print(f"Got ancestor chain: {chain}")
+            chains.append(chain)
+
+        records = db.get_cached_branches(list({tid for chain in chains for tid in chain[1:]}))
+
+        for chain in chains:
             current_node = tree
 
             # Skip the first element (root 48460) to avoid linking the root to itself
@@ -232,8 +241,8 @@ class DataProcessor:
                 if taxon_id in node_map:
                     child_node = node_map[taxon_id]
                 else:
-                    # Otherwise, fetch the record from the database and create a new node
-                    record = db.get_cached_branch(taxon_id)
+                    # Otherwise, build a new node from the prefetched record
+                    record = records.get(taxon_id)
                     if not record:
                         print(f"Warning: Missing taxon record for {taxon_id}")
                         continue  # Skip if record is missing
@@ -243,17 +252,18 @@ class DataProcessor:
                         "name": record["name"],
                         "rank": record["rank"],
                         "common_name": record.get("common_name", ""),
-                        "children": {}
+                        "children": []
                     }
                     node_map[taxon_id] = child_node  # Store in our global map
 
                 # Link the child node to the current node if not already linked
-                key = str(taxon_id)
-                if key not in current_node["children"]:
-                    current_node["children"][key] = child_node
-                    print(f"Added node {key} to tree: {child_node}")
+                key = (current_node["id"], taxon_id)
+                if key not in linked:
+                    current_node["children"].append(child_node)
+                    linked.add(key)
+                    print(f"Added node {taxon_id} to tree: {child_node}")
                 else:
-                    print(f"Node {key} already exists in tree")
+                    print(f"Node {taxon_id} already exists in tree")
 
                 # Move current_node pointer to the child for the next iteration
                 current_node = child_node
@@ -293,11 +303,8 @@ class DataProcessor:
         tree = DataProcessor.merge_branches_into_tree(species_ids)
 
         if root_id:
-            try:
-                taxonomy_cache = TaxonomyCache()
-                taxonomy_cache.save_tree(root_id=root_id, tree=tree)
-            except Exception as e:
-                print(f"Failed to save tree to cache: {e}")
+            # Failures are logged by the background writer
+            TaxonomyCache.save_tree_async(root_id=root_id, tree=tree)
 
         return tree
 
@@ -309,7 +316,7 @@ class DataProcessor:
             "name": name,
             "rank": rank,
             "common_name": common_name,
-            "children": {}
+            "children": []
         }
 
     @staticmethod
@@ -350,7 +357,7 @@ class DataProcessor:
                         child_data = rank_data[child_id]
                         break
                 if child_data:
-                    parent_node["children"][str(child_id)] = child_data
+                    parent_node["children"].append(child_data)
                     add_to_tree(child_id, child_data)
 
         add_to_tree(48460, tree)
@@ -373,7 +380,7 @@ class DataProcessor:
             "name": "Life",
             "rank": "stateofmatter",
             "common_name": "",
-            "children": {}
+            "children": []
         }
         for _, row in df.iterrows():
             for rank in DataProcessor.TAXONOMIC_RANKS:
@@ -392,7 +399,7 @@ class DataProcessor:
                             "name": name,
                             "common_name": common_name,
                             "rank": rank,
-                            "children": {}
+                            "children": []
                         }
             if pd.notna(row.get("taxon_id")) and row.get("rank") not in DataProcessor.TAXONOMIC_RANKS:
                 taxon_id = int(row["taxon_id"])
@@ -402,24 +409,27 @@ class DataProcessor:
                         "name": row["name"],
                         "common_name": row["common_name"],
                         "rank": row["rank"],
-                        "children": {}
+                        "children": []
                     }
                     print(f"Adding observation taxon - ID: {taxon_id}, Rank: {row['rank']}, Name: {row['name']}")
         print(f"\nCollected {len(taxa_info)} unique taxa")
+        # Finds an existing child by (parent's children list, child_id) while building
+        child_lookup = {}
         for _, row in df.iterrows():
-            current_level = root["children"]
+            current_node = root
             path = []
             for rank in DataProcessor.TAXONOMIC_RANKS:
                 if pd.notna(row.get(rank)):
                     path.append((rank, int(row[rank])))
             if path:
                 for i, (rank, taxon_id) in enumerate(path):
-                    str_id = str(taxon_id)
-                    if str_id not in current_level and taxon_id in taxa_info:
+                    key = (id(current_node["children"]), taxon_id)
+                    if key not in child_lookup and taxon_id in taxa_info:
                         print(f"Adding node to tree - ID: {taxon_id}, Rank: {rank}")
-                        current_level[str_id] = taxa_info[taxon_id].copy()
-                    if i < len(path) - 1 and str_id in current_level:
-                        current_level = current_level[str_id]["children"]
+                        child_lookup[key] = taxa_info[taxon_id].copy()
+                        current_node["children"].append(child_lookup[key])
+                    if i < len(path) - 1 and key in child_lookup:
+                        current_node = child_lookup[key]
         print(f"\nFinal tree structure summary:")
         print(f"Root children count: {len(root['children'])}")
         def print_tree(node, level=0):
@@ -428,9 +438,9 @@ class DataProcessor:
             indent = "  " * level
             name = node.get("name", "Unknown")
             rank = node.get("rank", "Unknown")
-            children = node.get("children", {})
+            children = node.get("children", [])
             print(f"{indent}{name} ({rank})")
-            for child in children.values():
+            for child in children:
                 print_tree(child, level + 1)
         print("\nTree structure:")
         print_tree(root)
@@ -442,34 +452,35 @@ class DataProcessor:
         if not tree:
             print("Warning: Empty tree provided for conversion")
             return {}
-        def convert_node(node: Dict) -> Dict:
-            if not isinstance(node, dict):
-                print(f"Warning: Invalid node type: {type(node)}")
-                return {}
-            new_node = {
+        if not isinstance(tree, dict):
+            print(f"Warning: Invalid node type: {type(tree)}")
+            return {}
+        def copy_node(node: Dict) -> Dict:
+            return {
                 "id": node.get("id"),
                 "name": node.get("name", ""),
                 "rank": node.get("rank", ""),
                 "common_name": node.get("common_name", ""),
-                "children": {}
+                "children": []
             }
-            children = node.get("children", {})
-            if isinstance(children, dict):
+        # Explicit stack instead of recursion, so deep trees cannot hit the
+        # recursion limit; each node's children are still added in sorted order.
+        converted = copy_node(tree)
+        stack = [(tree, converted)]
+        while stack:
+            node, new_node = stack.pop()
+            children = node.get("children", [])
+            if isinstance(children, list):
                 sorted_children = sorted(
-                    children.items(),
-                    key=lambda x: (
-                        {"stateofmatter": 0, "kingdom": 1, "phylum": 2, "class": 3,
-                         "order": 4, "family": 5, "genus": 6, "species": 7}.get(x[1].get('rank', ''), 999),
-                        x[1].get('name', '')
-                    )
+                    (child for child in children if isinstance(child, dict)),
+                    key=lambda child: (RANK_ORDER.get(child.get('rank', ''), 999), child.get('name', ''))
                 )
-                for child_id, child in sorted_children:
-                    if isinstance(child, dict):
-                        converted_child = convert_node(child)
-                        if converted_child and converted_child.get("id"):
-                            new_node["children"][str(child_id)] = converted_child
-            return new_node
-        return convert_node(tree)
+                for child in sorted_children:
+                    if child.get("id"):
+                        new_child = copy_node(child)
+                        new_node["children"].append(new_child)
+                        stack.append((child, new_child))
+        return converted
 
     # The debug_taxon_record method remains here (commented out) in case you need it in the future.
     """
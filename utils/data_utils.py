@@ -1,4 +1,11 @@
-from typing import Dict, List, Union, Any
+import ast
+import json
+from functools import lru_cache
+from typing import Dict, List, Union, Any, Tuple
+
+# Sort position of each rank among siblings; unknown ranks sort last (999).
+RANK_ORDER = {"stateofmatter": 0, "kingdom": 1, "phylum": 2, "class": 3,
+              "order": 4, "family": 5, "genus": 6, "species": 7}
 
 def normalize_ancestors(ancestors: Union[Dict, List, Any]) -> List[Dict]:
     """Normalize ancestor data into a consistent list format."""
@@ -16,4 +23,21 @@ def normalize_ancestors(ancestors: Union[Dict, List, Any]) -> List[Dict]:
             }]
     elif isinstance(ancestors, list):
         return ancestors
-    return [] 
\ No newline at end of file
+    return [] 
+
+def parse_ancestor_ids(ancestor_ids: Union[str, List[int], None]) -> List[int]:
+    """Return ancestor_ids as a list, parsing the string form (e.g. "[48460, 1, 2]") if needed."""
+    if isinstance(ancestor_ids, str):
+        return list(_parse_ancestor_string(ancestor_ids))
+    return list(ancestor_ids) if ancestor_ids else []
+
+@lru_cache(maxsize=4096)
+def _parse_ancestor_string(text: str) -> Tuple:
+    # Taxa of the same genus or family share identical strings, so parses are
+    # memoized. JSON covers the usual "[1, 2, 3]" form; literal_eval accepts
+    # any other Python literal (tuples, etc.) without executing code.
+    try:
+        parsed = json.loads(text)
+    except ValueError:
+        parsed = ast.literal_eval(text)
+    return tuple(parsed)
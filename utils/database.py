@@ -1,8 +1,54 @@
 import os
+import threading
+from collections import OrderedDict
+import numpy as np
 import psycopg2
-from psycopg2.extras import DictCursor, Json
-from typing import Optional, Dict
-from datetime import datetime, timezone
+from psycopg2.extras import DictCursor, Json, register_default_jsonb
+from typing import Optional, Dict, List
+from uuid import uuid4
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib json module
+    orjson = None
+
+if orjson is not None:
+    # Parse JSONB results (cached trees) with orjson as well.
+    register_default_jsonb(globally=True, loads=orjson.loads)
+
+class FastJson(Json):
+    """Json adapter that serializes with orjson when it is installed."""
+
+    def dumps(self, obj):
+        if orjson is None:
+            return super().dumps(obj)
+        # Tree nodes keep children in lists, so every dict key is a string
+        # and orjson's default (str keys only) applies.
+        return orjson.dumps(obj).decode()
+
+# Bump whenever the shape of cached tree JSON changes, so stale rows are
+# simply never hit again (they age out via the TaxonomyCache sweep).
+# v2: node children are stored as lists instead of dicts keyed by taxon_id.
+TREE_SCHEMA_VERSION = 2
+
+def tree_cache_key(root_id: int) -> str:
+    """Key under which the complete tree for root_id is cached in filtered_trees."""
+    return f"{root_id}_v{TREE_SCHEMA_VERSION}"
+
+# Process-local LRU of taxa rows keyed by taxon_id. The same higher ranks
+# (Animalia, Chordata, Aves, ...) are looked up for nearly every species, and
+# save_branch never overwrites an existing row, so cached rows stay valid
+# unless the taxa table is edited outside this app. Cached ancestor_ids are
+# packed into int32 arrays (4 bytes per ID instead of a list of int objects)
+# and unpacked into a fresh list on every hit.
+_TAXA_CACHE_MAXSIZE = 100_000
+_taxa_cache: "OrderedDict[int, Dict]" = OrderedDict()
+_taxa_cache_lock = threading.Lock()
+
+def clear_taxa_cache() -> None:
+    """Forget all cached taxa rows, e.g. after the taxa table was modified externally."""
+    with _taxa_cache_lock:
+        _taxa_cache.clear()
 
 class Database:
     _instance = None
@@ -45,20 +91,24 @@ class Database:
             );
 
             CREATE INDEX IF NOT EXISTS taxa_rank_idx ON taxa(rank);
-            CREATE INDEX IF NOT EXISTS taxa_ancestor_ids_idx ON taxa USING gin(ancestor_ids);
+            DROP INDEX IF EXISTS taxa_ancestor_ids_idx;
 
             CREATE TABLE IF NOT EXISTS filtered_trees (
                 cache_key TEXT PRIMARY KEY,
                 filtered_tree JSONB NOT NULL,
                 created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
             );
-            CREATE INDEX IF NOT EXISTS filtered_trees_created_idx ON filtered_trees(created_at);
+            DROP INDEX IF EXISTS filtered_trees_created_idx;
+            CREATE INDEX IF NOT EXISTS filtered_trees_created_brin ON filtered_trees USING BRIN(created_at);
             """)
             # Note: With autocommit enabled, an explicit commit is not necessary.
             # However, if you wish to be extra sure, you can leave this line.
             self.conn.commit()
 
     def get_cached_branch(self, taxon_id: int) -> Optional[Dict]:
+        cached = self._cache_get(taxon_id)
+        if cached is not None:
+            return cached
         try:
             with self.conn.cursor(cursor_factory=DictCursor) as cur:
                 cur.execute("""
@@ -68,18 +118,79 @@ class Database:
                 """, (taxon_id,))
                 result = cur.fetchone()
                 if result:
-                    return {
-                        "id": result["taxon_id"],
-                        "name": result["name"],
-                        "rank": result["rank"],
-                        "common_name": result["common_name"],
-                        "parent_id": result["parent_id"],
-                        "ancestor_ids": result["ancestor_ids"] or []
-                    }
+                    branch = self._row_to_branch(result)
+                    self._cache_put(branch)
+                    return branch
         except Exception as e:
             print(f"Error getting cached branch for {taxon_id}: {e}")
         return None
 
+    def get_cached_branches(self, taxon_ids: List[int]) -> Dict[int, Dict]:
+        """
+        Fetch many taxa in a single query, keyed by taxon_id.
+        Rows are streamed from a server-side cursor in batches of itersize,
+        so large life lists never hold the whole result set client-side.
+        """
+        branches = {}
+        missing = []
+        for taxon_id in taxon_ids:
+            cached = self._cache_get(taxon_id)
+            if cached is not None:
+                branches[taxon_id] = cached
+            else:
+                missing.append(taxon_id)
+        if not missing:
+            return branches
+        try:
+            # Named cursors must be declared WITH HOLD to work under autocommit.
+            with self.conn.cursor(name=f"taxa_{uuid4().hex}", cursor_factory=DictCursor,
+                                  withhold=True) as cur:
+                cur.itersize = 2000
+                cur.execute("""
+                    SELECT taxon_id, name, rank, common_name, parent_id, ancestor_ids
+                    FROM taxa
+                    WHERE taxon_id = ANY(%s)
+                """, (missing,))
+                for row in cur:
+                    branch = self._row_to_branch(row)
+                    self._cache_put(branch)
+                    branches[branch["id"]] = branch
+        except Exception as e:
+            print(f"Error getting cached branches: {e}")
+        return branches
+
+    @staticmethod
+    def _cache_get(taxon_id: int) -> Optional[Dict]:
+        """Return a copy of a cached taxa row, marking it most recently used."""
+        with _taxa_cache_lock:
+            branch = _taxa_cache.get(taxon_id)
+            if branch is None:
+                return None
+            _taxa_cache.move_to_end(taxon_id)
+        cached = dict(branch)
+        cached["ancestor_ids"] = branch["ancestor_ids"].tolist()
+        return cached
+
+    @staticmethod
+    def _cache_put(branch: Dict) -> None:
+        packed = dict(branch, ancestor_ids=np.asarray(branch["ancestor_ids"], dtype=np.int32))
+        with _taxa_cache_lock:
+            _taxa_cache[branch["id"]] = packed
+            _taxa_cache.move_to_end(branch["id"])
+            if len(_taxa_cache) > _TAXA_CACHE_MAXSIZE:
+                _taxa_cache.popitem(last=False)
+
+    @staticmethod
+    def _row_to_branch(row) -> Dict:
+        return {
+            "id": row["taxon_id"],
+            "name": row["name"],
+            "rank": row["rank"],
+            "common_name": row["common_name"],
+            "parent_id": row["parent_id"],
+            "ancestor_ids": row["ancestor_ids"] or []
+        }
+
     def save_branch(self, taxon_id: int, taxon_data: Dict) -> None:
         """Save a taxon record only if it doesn't already exist."""
         try:
@@ -94,8 +205,8 @@ class Database:
 
                 cur.execute("""
                     INSERT INTO taxa 
-                    (taxon_id, name, rank, common_name, parent_id, ancestor_ids, last_updated)
-                    VALUES (%s, %s, %s, %s, %s, %s, NOW())
+                    (taxon_id, name, rank, common_name, parent_id, ancestor_ids)
+                    VALUES (%s, %s, %s, %s, %s, %s)
                     ON CONFLICT (taxon_id) DO NOTHING
                 """, (
                     taxon_id,
@@ -122,8 +233,9 @@ class Database:
                     SELECT filtered_tree, created_at
                     FROM filtered_trees
                     WHERE cache_key = %s
+                    AND created_at > NOW() - make_interval(days => %s)
                 """
-                cur.execute(query, (str(root_id),))
+                cur.execute(query, (tree_cache_key(root_id), int(max_age_days)))
                 result = cur.fetchone()
                 if result:
                     tree_data, created_at = result
@@ -147,8 +259,8 @@ class Database:
                         filtered_tree = EXCLUDED.filtered_tree,
                         created_at = NOW()
                 """, (
-                    str(root_id),
-                    Json(tree)
+                    tree_cache_key(root_id),
+                    FastJson(tree)
                 ))
                 self.conn.commit()
                 print(f"Saved complete tree to cache with root {root_id}")
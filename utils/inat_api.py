@@ -141,8 +141,9 @@ class INaturalistAPI:
             "name": "Life",
             "rank": "stateofmatter",
             "common_name": "Life",
-            "children": {}
+            "children": []
         }
+        linked = {}  # (id of parent node, child_id) -> node already in its children list
         db = Database.get_instance()
         for species_id in species_ids:
             print(f"\nProcessing species {species_id}")
@@ -150,26 +151,27 @@ class INaturalistAPI:
             print(f"Got ancestor chain: {chain}")
             current_node = tree
             for taxon_id in chain:
-                key = str(taxon_id)
+                key = (id(current_node), taxon_id)
                 record = db.get_cached_branch(taxon_id)
                 if record:
                     print(f"[DEBUG] Found record for taxon {taxon_id}: {record}")
-                    if key not in current_node["children"]:
-                        current_node["children"][key] = {
+                    if key not in linked:
+                        linked[key] = {
                             "id": record["id"],
                             "name": record["name"],
                             "rank": record["rank"],
                             "common_name": record.get("common_name", ""),
-                            "children": {}
+                            "children": []
                         }
-                        print(f"Added node {key} to tree: {current_node['children'][key]}")
+                        current_node["children"].append(linked[key])
+                        print(f"Added node {taxon_id} to tree: {linked[key]}")
                     else:
-                        print(f"Node {key} already exists in tree")
+                        print(f"Node {taxon_id} already exists in tree")
                 else:
                     print(f"[DEBUG] No record found for taxon {taxon_id}")
                     print(f"Warning: Missing taxon record for {taxon_id}")
                     continue
-                current_node = current_node["children"][key]
+                current_node = linked[key]
         print(f"\nFinal tree structure:")
         print(f"Root children count: {len(tree['children'])}")
         return tree
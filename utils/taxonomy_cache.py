@@ -1,11 +1,56 @@
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
+import hashlib
 import json
-from datetime import datetime, timezone
+import logging
+import struct
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 import psycopg2
-from psycopg2.extras import Json
+from psycopg2.extras import execute_values
 import os
+from utils.database import FastJson, TREE_SCHEMA_VERSION, tree_cache_key
+from utils.data_utils import RANK_ORDER
+
+logger = logging.getLogger(__name__)
+
+# Cache writes are not needed to answer the current request, so they run on a
+# single background thread instead of delaying the tree render.
+_cache_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="taxonomy-cache-writer")
+
+
+def _log_write_failure(future: Future) -> None:
+    """Done-callback logging any exception a background cache write raised."""
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Background cache write failed", exc_info=future.exception())
+
+
+def _submit_cache_write(write) -> Future:
+    """Run write() on the cache writer thread; failures are logged, not lost."""
+    future = _cache_writer.submit(write)
+    future.add_done_callback(_log_write_failure)
+    return future
+
+
+# Expired rows are swept by the first TaxonomyCache built in this process
+# rather than by every instance (build_taxonomy_hierarchy makes several).
+_sweep_done = False
+_sweep_lock = threading.Lock()
+
+# The schema (table, index and filter_subtree) is likewise set up once per
+# process instead of on every construction.
+_schema_ready = False
+_schema_lock = threading.Lock()
 
 class TaxonomyCache:
+    # Rows older than this are never served by any reader, so the
+    # once-per-process sweep removes them to keep the filtered_trees primary key small.
+    CACHE_MAX_AGE_DAYS = 30
+    # Arbitrary advisory-lock key so only one worker sweeps at a time.
+    _SWEEP_LOCK_ID = 48460
+    # Advisory-lock key serializing schema setup across processes; concurrent
+    # CREATE OR REPLACE FUNCTION calls can fail with "tuple concurrently updated".
+    _SCHEMA_LOCK_ID = 48461
+
     def __init__(self):
         """Initialize database connection and ensure tables exist."""
         self.conn = None
@@ -22,9 +67,20 @@ class TaxonomyCache:
             self.conn = None
 
     def _ensure_tables(self):
-        """Create necessary tables if they don't exist."""
+        """Create necessary tables if they don't exist, once per process."""
+        global _schema_ready
+        if self.conn is None:
+            return
+        with _schema_lock:
+            if not _schema_ready:
+                _schema_ready = self._create_schema()
+        self._sweep_expired_once()
+
+    def _create_schema(self) -> bool:
+        """Create the cache table, its index and filter_subtree in one transaction."""
         try:
             with self.conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_xact_lock(%s)", (self._SCHEMA_LOCK_ID,))
                 # Table for caching complete trees.
                 cur.execute("""
                     CREATE TABLE IF NOT EXISTS filtered_trees (
@@ -32,12 +88,86 @@ class TaxonomyCache:
                         filtered_tree JSONB NOT NULL,
                         created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
                     );
-                    CREATE INDEX IF NOT EXISTS filtered_trees_created_idx 
-                        ON filtered_trees(created_at);
+                    DROP INDEX IF EXISTS filtered_trees_created_idx;
+                    CREATE INDEX IF NOT EXISTS filtered_trees_created_brin
+                        ON filtered_trees USING BRIN(created_at);
                 """)
-                self.conn.commit()
+
+                # Server-side counterpart of _filter_tree_for_species, so a
+                # cached complete tree can be pruned before it leaves the DB.
+                cur.execute("""
+                    CREATE OR REPLACE FUNCTION filter_subtree(tree JSONB, ids INTEGER[])
+                    RETURNS JSONB
+                    LANGUAGE plpgsql IMMUTABLE AS $$
+                    DECLARE
+                        kept JSONB := '[]'::JSONB;
+                    BEGIN
+                        IF jsonb_typeof(tree) <> 'object' OR NOT tree ? 'id' THEN
+                            RETURN NULL;
+                        END IF;
+                        IF tree->>'rank' = 'species' THEN
+                            IF NOT (tree->>'id')::INTEGER = ANY(ids) THEN
+                                RETURN NULL;
+                            END IF;
+                        ELSE
+                            -- One aggregate per node, rather than appending to
+                            -- (and so copying) the array once per child.
+                            SELECT jsonb_agg(c.kept_child ORDER BY c.ord)
+                                       FILTER (WHERE c.kept_child IS NOT NULL)
+                            INTO kept
+                            FROM (
+                                SELECT filter_subtree(e.child, ids) AS kept_child, e.ord
+                                FROM jsonb_array_elements(
+                                    CASE WHEN jsonb_typeof(tree->'children') = 'array'
+                                         THEN tree->'children' ELSE '[]'::JSONB END
+                                ) WITH ORDINALITY AS e(child, ord)
+                            ) c;
+                            IF kept IS NULL THEN
+                                RETURN NULL;
+                            END IF;
+                        END IF;
+                        RETURN jsonb_build_object(
+                            'id', tree->'id',
+                            'name', COALESCE(tree->'name', '""'::JSONB),
+                            'rank', COALESCE(tree->'rank', '""'::JSONB),
+                            'common_name', COALESCE(tree->'common_name', '""'::JSONB),
+                            'children', kept
+                        );
+                    END
+                    $$;
+                """)
+            self.conn.commit()
+            return True
         except Exception as e:
+            self.conn.rollback()
             print(f"Error creating tables: {e}")
+            return False
+
+    def _sweep_expired_once(self):
+        """Evict expired rows, until one sweep succeeds in this process."""
+        global _sweep_done
+        if self.conn is None:
+            return
+        with _sweep_lock:
+            if _sweep_done:
+                return
+            try:
+                with self.conn.cursor() as cur:
+                    # The xact lock is released on commit, and keeps other
+                    # processes from sweeping at the same time.
+                    cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (self._SWEEP_LOCK_ID,))
+                    if cur.fetchone()[0]:
+                        cur.execute("""
+                            DELETE FROM filtered_trees
+                            WHERE created_at < NOW() - make_interval(days => %s)
+                        """, (self.CACHE_MAX_AGE_DAYS,))
+                        if cur.rowcount:
+                            logger.info("Evicted %d expired cached trees", cur.rowcount)
+                self.conn.commit()
+                _sweep_done = True
+            except Exception as e:
+                self.conn.rollback()
+                logger.warning("Error evicting expired cached trees: %s", e)
 
     def get_cached_tree(self, root_id: int, max_age_days: int = 30) -> Optional[Dict]:
         """Retrieve a cached complete tree using the root_id as key."""
@@ -47,8 +177,9 @@ class TaxonomyCache:
                     SELECT filtered_tree, created_at
                     FROM filtered_trees
                     WHERE cache_key = %s
+                    AND created_at > NOW() - make_interval(days => %s)
                 """
-                cur.execute(query, (str(root_id),))
+                cur.execute(query, (tree_cache_key(root_id), int(max_age_days)))
                 result = cur.fetchone()
                 if result:
                     tree_data, created_at = result
@@ -62,24 +193,51 @@ class TaxonomyCache:
 
     def save_tree(self, root_id: int, tree: Dict) -> None:
         """Save a complete tree to the 'filtered_trees' table using the root_id as key."""
+        self._write_cache_rows({tree_cache_key(root_id): tree})
+
+    def save_trees_bulk(self, items: List[Tuple[int, Dict]]) -> None:
+        """
+        Save several complete (root_id, tree) pairs in a single upsert.
+        If a root_id repeats, the last tree given for it wins.
+        """
+        # One statement may not update the same row twice, so de-duplicate keys.
+        self._write_cache_rows({tree_cache_key(root_id): tree for root_id, tree in items})
+
+    @staticmethod
+    def save_tree_async(root_id: int, tree: Dict) -> Future:
+        """
+        Queue save_tree on the background writer and return immediately.
+        The write runs on the writer thread's own TaxonomyCache and connection,
+        so no connection or table setup happens on the caller's path.
+        The tree must not be mutated until the returned future completes.
+        """
+        return _submit_cache_write(lambda: _writer_instance().save_tree(root_id, tree))
+
+    def _write_cache_rows(self, rows: Dict[str, Dict]) -> None:
+        """Upsert cache_key -> tree rows and commit them as one transaction."""
+        if not rows or self.conn is None:
+            return
         try:
             with self.conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO filtered_trees (cache_key, filtered_tree)
-                    VALUES (%s, %s)
-                    ON CONFLICT (cache_key) 
-                    DO UPDATE SET 
-                        filtered_tree = EXCLUDED.filtered_tree,
-                        created_at = NOW()
-                """, (
-                    str(root_id),
-                    Json(tree)
-                ))
-                self.conn.commit()
-                print(f"Saved complete tree to cache with root {root_id}")
+                self._upsert_cache_rows(cur, rows)
+            self.conn.commit()
+            logger.debug("Saved %d trees to cache", len(rows))
         except Exception as e:
+            self.conn.rollback()
             print(f"Error saving tree to cache: {e}")
 
+    @staticmethod
+    def _upsert_cache_rows(cur, rows: Dict[str, Dict]) -> None:
+        """Upsert rows on an open cursor; the caller owns the transaction."""
+        execute_values(cur, """
+            INSERT INTO filtered_trees (cache_key, filtered_tree)
+            VALUES %s
+            ON CONFLICT (cache_key) 
+            DO UPDATE SET 
+                filtered_tree = EXCLUDED.filtered_tree,
+                created_at = NOW()
+        """, [(key, FastJson(tree)) for key, tree in rows.items()], page_size=100)
+
     def get_ancestors(self, species_id: int) -> Optional[List[Dict]]:
         """
         Retrieve the cached ancestor information for a species.
@@ -91,9 +249,12 @@ class TaxonomyCache:
         cached_data = db.get_cached_branch(species_id)
         if cached_data and cached_data.get("ancestor_ids"):
             print(f"Found cached ancestor_ids for species {species_id}")
+            ancestor_ids = cached_data.get("ancestor_ids")
+            # One batched lookup instead of a query per ancestor
+            branches = db.get_cached_branches(ancestor_ids)
             ancestors = []
-            for aid in cached_data.get("ancestor_ids"):
-                ancestor = db.get_cached_branch(aid)
+            for aid in ancestor_ids:
+                ancestor = branches.get(aid)
                 if ancestor:
                     ancestors.append({
                         "id": ancestor["id"],
@@ -106,27 +267,67 @@ class TaxonomyCache:
         return None
 
     def get_filtered_user_tree(self, root_id: int, user_species_ids: List[int]) -> Optional[Dict]:
-        """Get a filtered tree for specific species, using cached data when possible."""
+        """
+        Get a filtered tree for specific species, using cached data when possible.
+        A freshly filtered tree is cached in the background, so it must not be
+        mutated before the writer has saved it.
+        """
         if not user_species_ids:
             print("No species IDs provided for filtering")
             return None
 
-        # Create a cache key based on root_id and sorted species_ids
-        cache_key = f"{root_id}_{','.join(sorted(map(str, user_species_ids)))}"
+        cache_key = self._filtered_cache_key(root_id, user_species_ids)
+        species_ids = sorted(set(int(i) for i in user_species_ids))
 
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                SELECT filtered_tree
-                FROM filtered_trees
-                WHERE cache_key = %s
-                AND created_at > NOW() - INTERVAL '7 days'
-            """, (cache_key,))
-            result = cur.fetchone()
-            if result:
-                print(f"Found cached filtered tree for {len(user_species_ids)} species")
-                # For simplicity, return the cached tree.
-                return result[0]
-        return None
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute("""
+                    SELECT filtered_tree
+                    FROM filtered_trees
+                    WHERE cache_key = %s
+                    AND created_at > NOW() - INTERVAL '7 days'
+                """, (cache_key,))
+                result = cur.fetchone()
+                if result:
+                    print(f"Found cached filtered tree for {len(user_species_ids)} species")
+                    # For simplicity, return the cached tree.
+                    return result[0]
+
+                # Otherwise prune the cached complete tree inside Postgres, so
+                # only the kept nodes are sent over the wire.
+                cur.execute("""
+                    SELECT filter_subtree(filtered_tree, %s)
+                    FROM filtered_trees
+                    WHERE cache_key = %s
+                    AND created_at > NOW() - make_interval(days => %s)
+                """, (species_ids, tree_cache_key(root_id), self.CACHE_MAX_AGE_DAYS))
+                result = cur.fetchone()
+            filtered = result[0] if result else None
+        except psycopg2.Error as e:
+            # e.g. the function could not be created or the connection's
+            # transaction is aborted; filter in Python instead
+            self.conn.rollback()
+            logger.warning("Server-side tree filtering failed, falling back to Python: %s", e)
+            complete_tree = self.get_cached_tree(root_id, self.CACHE_MAX_AGE_DAYS)
+            filtered = self._filter_tree_for_species(complete_tree, set(species_ids))
+
+        if filtered:
+            # Cache it on the background writer; the caller only needs the tree.
+            _submit_cache_write(lambda: _writer_instance()._write_cache_rows({cache_key: filtered}))
+        return filtered
+
+    @staticmethod
+    def _filtered_cache_key(root_id: int, species_ids: List[int]) -> str:
+        """
+        Build a fixed-length cache key for a (root_id, species set) pair.
+        The tree schema version, root_id and sorted, de-duplicated IDs are
+        packed as little-endian uint32s and hashed with a 128-bit BLAKE2b
+        digest, so the key stays 32 hex chars no matter how many species
+        the user has.
+        """
+        ids = sorted(set(int(i) for i in species_ids))
+        packed = struct.pack(f"<II{len(ids)}I", TREE_SCHEMA_VERSION, int(root_id), *ids)
+        return hashlib.blake2b(packed, digest_size=16).hexdigest()
 
     def _get_ancestor_chain(self, species_id: int) -> List[Dict]:
         """
@@ -134,38 +335,20 @@ class TaxonomyCache:
         Returns a list of minimal dictionaries (id, name, rank) for each ancestor.
         """
         with self.conn.cursor() as cur:
+            # Resolve the species' ancestor_ids against taxa in a single query
             cur.execute("""
-                SELECT ancestor_chain
-                FROM species_ancestors
-                WHERE species_id = %s
-                ORDER BY last_updated DESC
-                LIMIT 1
+                SELECT a.taxon_id, a.name, a.rank
+                FROM taxa s
+                JOIN taxa a ON a.taxon_id = ANY(s.ancestor_ids)
+                WHERE s.taxon_id = %s
+                ORDER BY array_position(s.ancestor_ids, a.taxon_id)
             """, (species_id,))
-            result = cur.fetchone()
-            if not result or not result[0]:
-                return []
-
-            ancestor_chain = []
-            for ancestor_id in result[0]:
-                ancestor_info = self._get_node_info(ancestor_id)
-                if ancestor_info:
-                    ancestor_chain.append({
-                        "id": ancestor_id,
-                        "name": ancestor_info["name"],
-                        "rank": ancestor_info["rank"]
-                    })
-            # Sort by taxonomic rank using a predefined order
-            rank_order = {
-                "stateofmatter": 0,
-                "kingdom": 1,
-                "phylum": 2,
-                "class": 3,
-                "order": 4,
-                "family": 5,
-                "genus": 6,
-                "species": 7
-            }
-            ancestor_chain.sort(key=lambda x: rank_order.get(x["rank"], 999))
+            ancestor_chain = [
+                {"id": ancestor_id, "name": name, "rank": rank}
+                for ancestor_id, name, rank in cur.fetchall()
+            ]
+            # Sort by taxonomic rank using the shared rank order
+            ancestor_chain.sort(key=lambda x: RANK_ORDER.get(x["rank"], 999))
             return ancestor_chain
 
     def _get_node_info(self, node_id: int) -> Optional[Dict]:
@@ -214,36 +397,71 @@ class TaxonomyCache:
 
         print(f"Filtering tree to include only {len(keep_species)} species")
 
-        valid_taxa = set()
-
-        def find_valid_paths(node, current_path):
+        # Walk the tree once, remembering each node's parent, then climb from
+        # every target species to mark its path. Explicit stacks keep deep
+        # subtrees clear of the recursion limit.
+        parent_of = {}
+        targets = []
+        stack = [(tree, None)]
+        while stack:
+            node, parent_id = stack.pop()
             if not isinstance(node, dict) or "id" not in node:
-                return
-            current_path = current_path + [node["id"]]
-            if node.get("rank") == "species" and node["id"] in keep_species:
-                valid_taxa.update(current_path)
-            for child in node.get("children", {}).values():
-                find_valid_paths(child, current_path)
+                continue
+            node_id = node["id"]
+            parent_of[node_id] = parent_id
+            if node.get("rank") == "species":
+                # Nothing below a species can be a target, so stop here
+                if node_id in keep_species:
+                    targets.append(node_id)
+                continue
+            for child in node.get("children") or ():
+                stack.append((child, node_id))
 
-        find_valid_paths(tree, [])
+        valid_taxa = set()
+        for node_id in targets:
+            while node_id is not None and node_id not in valid_taxa:
+                valid_taxa.add(node_id)
+                node_id = parent_of[node_id]
         print(f"Found {len(valid_taxa)} taxa in paths to target species")
 
-        def filter_node(node):
-            if not isinstance(node, dict) or "id" not in node:
-                return None
-            if node["id"] not in valid_taxa:
-                return None
-            filtered = {
+        if tree.get("id") not in valid_taxa:
+            return None
+
+        def copy_node(node):
+            return {
                 "id": node["id"],
                 "name": node.get("name", ""),
                 "rank": node.get("rank", ""),
                 "common_name": node.get("common_name", ""),
-                "children": {}
+                "children": []
             }
-            for key, child in node.get("children", {}).items():
-                filtered_child = filter_node(child)
-                if filtered_child:
-                    filtered["children"][key] = filtered_child
-            return filtered
 
-        return filter_node(tree)
+        # Only kept nodes are ever pushed, so this pass is O(len(valid_taxa))
+        # plus the children lists of those nodes.
+        filtered_root = copy_node(tree)
+        stack = [(tree, filtered_root)]
+        while stack:
+            node, filtered = stack.pop()
+            kept_children = filtered["children"]
+            for child in node.get("children") or ():
+                if isinstance(child, dict) and child.get("id") in valid_taxa:
+                    filtered_child = copy_node(child)
+                    kept_children.append(filtered_child)
+                    stack.append((child, filtered_child))
+
+        return filtered_root
+
+
+# TaxonomyCache used only by the _cache_writer thread, so background writes
+# never share a connection (or a transaction) with a request's instance.
+_writer_cache: Optional[TaxonomyCache] = None
+
+
+def _writer_instance() -> TaxonomyCache:
+    """Return the writer thread's TaxonomyCache, creating or reconnecting it as needed."""
+    global _writer_cache
+    if _writer_cache is None:
+        _writer_cache = TaxonomyCache()
+    else:
+        _writer_cache.connect()
+    return _writer_cache
@@ -1,331 +1,544 @@
+import hashlib
+import logging
+import pickle
+import threading
+from collections import OrderedDict
 import plotly.graph_objects as go
-from typing import Dict, List, Tuple, Set, Optional
-import pandas as pd
+from typing import Dict, List, Tuple, Set, Optional, Union
 import numpy as np
+from utils.data_utils import RANK_ORDER, parse_ancestor_ids
+
+logger = logging.getLogger(__name__)
+
+# Keys every taxon node must carry (see validate_tree)
+_REQUIRED_FIELDS = frozenset({'id', 'name', 'rank', 'children'})
+
+# Recently built plot structures keyed by a digest of their input, so a
+# Streamlit rerun over an unchanged tree skips the rebuild. Every caller
+# shares the cached arrays, so they are marked read-only.
+_STRUCTURE_CACHE_MAXSIZE = 16
+_structure_cache: "OrderedDict[Tuple[str, str], Tuple[Dict[str, np.ndarray], np.ndarray]]" = OrderedDict()
+_structure_cache_lock = threading.Lock()
+
+def clear_structure_cache() -> None:
+    """Forget all cached plot structures."""
+    with _structure_cache_lock:
+        _structure_cache.clear()
+
+def _cached_structure(kind: str, data, build):
+    """Return build(data), reusing the result for byte-identical input."""
+    try:
+        payload = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:  # not picklable; just build without caching
+        return build(data)
+    key = (kind, hashlib.blake2b(payload, digest_size=16).hexdigest())
+    with _structure_cache_lock:
+        cached = _structure_cache.get(key)
+        if cached is not None:
+            _structure_cache.move_to_end(key)
+            return cached
+
+    nodes, edges = build(data)
+    for arr in (*nodes.values(), edges):
+        arr.flags.writeable = False
+    with _structure_cache_lock:
+        _structure_cache[key] = (nodes, edges)
+        _structure_cache.move_to_end(key)
+        if len(_structure_cache) > _STRUCTURE_CACHE_MAXSIZE:
+            _structure_cache.popitem(last=False)
+    return nodes, edges
+
+def _layout_kernel(indptr, indices, vertical_spacing, xs, ys):
+    """
+    Fill xs (depth) and ys for a tree in CSR form whose nodes are numbered in
+    pre-order, so parents precede children and leaves are in display order.
+    """
+    n = len(xs)
+    for i in range(n):
+        for k in range(indptr[i], indptr[i + 1]):
+            xs[indices[k]] = xs[i] + 1.0
+    # Stack leaves top to bottom, then centre each parent on its children
+    cursor = 0.0
+    for i in range(n):
+        if indptr[i] == indptr[i + 1]:
+            ys[i] = cursor
+            cursor += vertical_spacing
+    for i in range(n - 1, -1, -1):
+        start, end = indptr[i], indptr[i + 1]
+        if start < end:
+            total = 0.0
+            for k in range(start, end):
+                total += ys[indices[k]]
+            ys[i] = total / (end - start)
+
+# numba is optional and slow to import, so the compiled kernel is resolved
+# on the first layout instead of at import time. None means not resolved yet;
+# False means numba is unavailable.
+_compiled_layout_kernel = None
+
+def _get_compiled_layout_kernel():
+    global _compiled_layout_kernel
+    if _compiled_layout_kernel is None:
+        try:
+            from numba import njit
+        except ImportError:  # the layout loops then run as plain Python
+            _compiled_layout_kernel = False
+        else:
+            _compiled_layout_kernel = njit(cache=True)(_layout_kernel)
+    return _compiled_layout_kernel
+
+def _layout(indptr: np.ndarray, indices: np.ndarray, vertical_spacing: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return (xs, ys) node positions as float32 arrays, computed with Numba
+    when it is installed. Single precision is ample for screen coordinates
+    and halves the size of every array handed to Plotly.
+    """
+    n = len(indptr) - 1
+    compiled_kernel = _get_compiled_layout_kernel()
+    if compiled_kernel:
+        xs = np.zeros(n, dtype=np.float32)
+        ys = np.zeros(n, dtype=np.float32)
+        compiled_kernel(indptr, indices, vertical_spacing, xs, ys)
+        return xs, ys
+    # Plain lists index much faster than NumPy scalars in interpreted loops
+    xs = [0.0] * n
+    ys = [0.0] * n
+    _layout_kernel(indptr.tolist(), indices.tolist(), vertical_spacing, xs, ys)
+    return np.array(xs, dtype=np.float32), np.array(ys, dtype=np.float32)
 
 class TreeBuilder:
     @staticmethod
-    def build_taxonomy_tree(taxa_data: List[Dict]) -> Dict:
+    def build_taxonomy_tree(taxa_data: List[Dict], id_index: Optional[Dict[int, Dict]] = None) -> List[Dict]:
         """
         Build a complete taxonomy tree from taxa data.
 
         Args:
             taxa_data: List of dictionaries containing taxon information
                        Each dict should have: taxon_id, name, rank, ancestor_ids
+            id_index: Optional dict filled with taxon_id -> node as nodes are
+                      created (the first node wins for repeated IDs), ready to
+                      pass to find_root_node / collect_all_taxa_ids
+
+        Returns:
+            The list of top-level nodes; each node keeps its children in a list.
         """
-        print("\nStarting tree building...")
+        logger.debug("Starting tree building for %d taxa", len(taxa_data))
         # Initialize the complete tree
-        complete_tree = {}
+        complete_tree = []
+        # Finds an existing child by (parent's children list, child_id) while
+        # building; a taxon may sit under several parents, so the parent's
+        # taxon ID alone is not enough.
+        child_lookup = {}
+        # Resolves ancestor IDs to their taxon records in O(1); built in
+        # reverse so the first record wins for duplicate IDs, as before
+        by_id = {t['taxon_id']: t for t in reversed(taxa_data)}
+
+        def get_or_add_node(siblings: List[Dict], data: Dict) -> Dict:
+            """Return the node for this taxon in siblings, adding it if missing."""
+            key = (id(siblings), data['taxon_id'])
+            node = child_lookup.get(key)
+            if node is None:
+                node = {
+                    'id': int(data['taxon_id']),  # int IDs, so lookups need no casts
+                    'name': data['name'],
+                    'rank': data['rank'],
+                    'children': [],
+                    'common_name': data.get('common_name', '')
+                }
+                siblings.append(node)
+                child_lookup[key] = node
+                if id_index is not None:
+                    id_index.setdefault(node['id'], node)
+            return node
+
+        # Taxa of one genus share an identical ancestor chain, so the node
+        # each distinct chain ends at is resolved once and then reused.
+        chain_ends = {}
 
         def add_taxon_to_tree(taxon: Dict, ancestors: List[int]):
             """Add a single taxon and its ancestors to the tree."""
-            current_dict = complete_tree
-
-            # First add all ancestors in order
-            for ancestor_id in ancestors:
-                # Find ancestor data
-                ancestor_data = next(
-                    (t for t in taxa_data if t['taxon_id'] == ancestor_id), 
-                    None
-                )
-                if ancestor_data:
-                    if ancestor_id not in current_dict:
-                        current_dict[ancestor_id] = {
-                            'id': ancestor_id,
-                            'name': ancestor_data['name'],
-                            'rank': ancestor_data['rank'],
-                            'children': {},
-                            'common_name': ancestor_data.get('common_name', '')
-                        }
-                    current_dict = current_dict[ancestor_id]['children']
+            chain = tuple(ancestors)
+            end = chain_ends.get(chain)
+            if end is None:
+                siblings = complete_tree
+
+                # First add all ancestors in order
+                for ancestor_id in chain:
+                    # Find ancestor data
+                    ancestor_data = by_id.get(ancestor_id)
+                    if ancestor_data:
+                        siblings = get_or_add_node(siblings, ancestor_data)['children']
+                end = chain_ends[chain] = siblings
 
             # Then add the taxon itself
-            if taxon['taxon_id'] not in current_dict:
-                current_dict[taxon['taxon_id']] = {
-                    'id': taxon['taxon_id'],
-                    'name': taxon['name'],
-                    'rank': taxon['rank'],
-                    'children': {},
-                    'common_name': taxon.get('common_name', '')
-                }
+            get_or_add_node(end, taxon)
 
-        # Process each taxon
+        # Process each taxon; the level check is hoisted out of the loop
+        debug = logger.isEnabledFor(logging.DEBUG)
         for taxon in taxa_data:
             try:
                 # Parse ancestor_ids from string to list of integers if needed
-                ancestor_ids = eval(taxon['ancestor_ids']) if isinstance(taxon['ancestor_ids'], str) else taxon['ancestor_ids']
+                ancestor_ids = parse_ancestor_ids(taxon['ancestor_ids'])
                 if ancestor_ids:
-                    print(f"Processing {taxon['name']} with {len(ancestor_ids)} ancestors")
+                    if debug:
+                        logger.debug("Processing %s with %d ancestors", taxon['name'], len(ancestor_ids))
                     add_taxon_to_tree(taxon, ancestor_ids)
             except Exception as e:
-                print(f"Error processing taxon {taxon.get('taxon_id', 'unknown')}: {e}")
+                logger.warning("Error processing taxon %s: %s", taxon.get('taxon_id', 'unknown'), e)
                 continue
 
         if not TreeBuilder.validate_tree(complete_tree):
-            print("Warning: Built tree failed validation")
+            logger.warning("Built tree failed validation")
 
         return complete_tree
 
     @staticmethod
-    def find_root_node(tree: Dict, root_id: int) -> Optional[Dict]:
-        """Find and extract the subtree starting from a specific root ID."""
-        def find_node(current_tree: Dict, target_id: int) -> Optional[Dict]:
-            # Check if the current node is our target
-            for node_id, node_data in current_tree.items():
-                if int(node_id) == target_id:  # Convert string keys to int for comparison
-                    return node_data
-
-                # Recursively search children
-                if 'children' in node_data:
-                    result = find_node(node_data['children'], target_id)
-                    if result:
-                        return result
-            return None
+    def build_id_index(tree: List[Dict]) -> Dict[int, Dict]:
+        """
+        Map every taxon ID in the tree to its node, given the top-level nodes.
+        Build it once and pass it to find_root_node / collect_all_taxa_ids to
+        make repeated lookups O(1). If an ID occurs more than once, the first
+        node in depth-first order wins, as in find_root_node's own walk.
+        """
+        index = {}
+        stack = list(reversed(tree))
+        while stack:
+            node_data = stack.pop()
+            index.setdefault(node_data['id'], node_data)
+            if 'children' in node_data:
+                stack.extend(reversed(node_data['children']))
+        return index
 
-        return find_node(tree, root_id)
+    @staticmethod
+    def find_root_node(tree: List[Dict], root_id: int,
+                       index: Optional[Dict[int, Dict]] = None) -> Optional[Dict]:
+        """Find and extract the subtree starting from a specific root ID."""
+        if index is not None:
+            return index.get(root_id)
+        # Pre-order walk on an explicit stack; siblings are pushed in reverse
+        # so the first match in depth-first order is returned.
+        stack = list(reversed(tree))
+        while stack:
+            node_data = stack.pop()
+            if node_data['id'] == root_id:
+                return node_data
+            if 'children' in node_data:
+                stack.extend(reversed(node_data['children']))
+        return None
 
     @staticmethod
-    def collect_all_taxa_ids(tree: Dict) -> Set[int]:
-        """Collect all taxon IDs in the tree."""
+    def collect_all_taxa_ids(tree: Union[Dict, List[Dict]],
+                             index: Optional[Dict[int, Dict]] = None) -> Set[int]:
+        """
+        Collect all taxon IDs in a node's subtree or in a list of top-level
+        nodes (as build_taxonomy_tree returns), or in its prebuilt index if given.
+        """
+        if index is not None:
+            return set(index)
         taxa_ids = set()
-
-        def traverse(node: Dict):
+        stack = list(tree) if isinstance(tree, list) else [tree]
+        while stack:
+            node = stack.pop()
             if 'id' in node:
                 taxa_ids.add(node['id'])
-            for child in node.get('children', {}).values():
-                traverse(child)
-
-        traverse(tree)
+            stack.extend(node.get('children', []))
         return taxa_ids
 
     @staticmethod
-    def validate_tree(tree: Dict) -> bool:
-        """Validate the taxonomy tree structure."""
-        required_fields = {'id', 'name', 'rank', 'children'}
-
-        def validate_node(node: Dict) -> bool:
-            # Special case for root node which might not have all fields
-            if not node.get('id'):
-                return all(validate_node(child) for child in node.get('children', {}).values())
-
-            # Check that all required fields are present
-            if not all(field in node for field in required_fields):
-                print(f"Node missing required fields: {node.get('name', 'unknown')}")
+    def validate_tree(tree: List[Dict]) -> bool:
+        """Validate the taxonomy tree structure, given its top-level nodes."""
+        return all(TreeBuilder._validate_node(node) for node in tree)
+
+    @staticmethod
+    def _validate_node(root: Dict) -> bool:
+        """Validate a single node and everything below it."""
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            # Special case for root node which might not have all fields;
+            # otherwise check that all required fields are present
+            if node.get('id') and not _REQUIRED_FIELDS <= node.keys():
+                logger.warning("Node missing required fields: %s", node.get('name', 'unknown'))
                 return False
+            stack.extend(reversed(node.get('children', [])))
+        return True
 
-            # Recursively validate children
-            return all(validate_node(child) for child in node.get('children', {}).values())
+    @staticmethod
+    def create_tree_structure(hierarchy: Union[Dict, List[Dict]]) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+        """
+        Convert hierarchy to a format suitable for plotting.
 
-        return all(validate_node(node) for node in tree.values())
+        Returns parallel node arrays ("ids", "names", "common_names", "ranks")
+        indexed by pre-order position, and an (E, 2) int32 array of
+        (parent, child) index pairs. Missing taxon IDs are stored as -1.
+        Results are cached by input content and the arrays are read-only.
+        """
+        return _cached_structure("hierarchy", hierarchy, TreeBuilder._build_tree_structure)
 
     @staticmethod
-    def create_tree_structure(hierarchy: Dict) -> Tuple[Dict, Dict]:
-        """Convert hierarchy to a format suitable for plotting."""
-        print("\nSTART OF HIERARCHY DEBUGGING")
+    def _build_tree_structure(hierarchy: Union[Dict, List[Dict]]) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+        ids, names, common_names, ranks = [], [], [], []
+        edges = []
 
         # Normalize the hierarchy into a proper node structure
-        if isinstance(hierarchy, dict):
-            if "id" in hierarchy and "children" in hierarchy:
+        if isinstance(hierarchy, (dict, list)):
+            if isinstance(hierarchy, dict) and "id" in hierarchy and "children" in hierarchy:
                 root_node = hierarchy
             else:
-                # Create a proper root node
+                # Hang a list of top-level nodes (or an empty tree) under Life
                 root_node = {
                     "id": 48460,  # Life
                     "name": "Life",
                     "rank": "stateofmatter",
                     "common_name": "",
-                    "children": hierarchy
+                    "children": hierarchy if isinstance(hierarchy, list) else list(hierarchy.values())
                 }
+            stack = [(root_node, -1)]
         else:
-            print(f"Invalid hierarchy type: {type(hierarchy)}")
-            return {}, []
-
-        def print_node(node, level=0):
-            indent = "  " * level
-            if isinstance(node, dict):
-                name = node.get("name", "")
-                rank = node.get("rank", "")
-                print(f"{indent}Node - Name: {name}, Rank: {rank}")
-                for child in node.get("children", {}).values():
-                    if isinstance(child, dict):
-                        print_node(child, level + 1)
-                    else:
-                        print(f"{indent}Invalid child type: {type(child)}")
-            else:
-                print(f"{indent}Invalid node type: {type(node)}")
-
-        print("Full hierarchy structure:")
-        print_node(root_node)
+            logger.warning("Invalid hierarchy type: %s", type(hierarchy))
+            stack = []
 
-        nodes = {}
-        edges = []
-        node_counter = 0
+        rank_index = RANK_ORDER.get
 
-        def traverse(node: Dict, parent_id: Optional[int] = None) -> int:
-            """Traverse the tree and build nodes and edges."""
-            nonlocal node_counter
-            current_id = node_counter
-            node_counter += 1
+        def sort_key(child):
+            if not isinstance(child, dict):
+                return (999, "")
+            return (rank_index(child.get("rank", ""), 999), child.get("name", ""))
 
-            if not isinstance(node, dict):
-                print(f"Warning: Invalid node type in traverse: {type(node)}")
-                return current_id
+        # Iterative pre-order walk. Children are pushed in reverse so they are
+        # popped, and therefore numbered, in sorted order.
+        while stack:
+            node, parent_id = stack.pop()
+            current_id = len(ids)
 
             # Create node entry
-            nodes[current_id] = {
-                "id": node.get("id"),
-                "name": node.get("name", ""),
-                "common_name": node.get("common_name", ""),
-                "rank": node.get("rank", "")
-            }
+            taxon_id = node.get("id")
+            ids.append(-1 if taxon_id is None else int(taxon_id))
+            names.append(node.get("name", ""))
+            common_names.append(node.get("common_name", ""))
+            ranks.append(node.get("rank", ""))
 
             # Add edge if this isn't the root
-            if parent_id is not None:
+            if parent_id >= 0:
                 edges.append((parent_id, current_id))
 
-            # Process children
-            children = node.get("children", {})
-            if isinstance(children, dict):
-                # Sort children by rank and name
-                sorted_children = sorted(
-                    children.items(),
-                    key=lambda x: (
-                        {"stateofmatter": 0, "kingdom": 1, "phylum": 2, "class": 3,
-                         "order": 4, "family": 5, "genus": 6, "species": 7}.get(
-                             x[1].get("rank", "") if isinstance(x[1], dict) else "", 999
-                         ),
-                        x[1].get("name", "") if isinstance(x[1], dict) else ""
-                    )
-                )
-
-                for _, child in sorted_children:
+            # Process children sorted by rank and name
+            children = node.get("children", [])
+            if isinstance(children, list):
+                sorted_children = sorted(children, key=sort_key)
+                for child in reversed(sorted_children):
                     if isinstance(child, dict):
-                        traverse(child, current_id)
+                        stack.append((child, current_id))
 
-            return current_id
+        return TreeBuilder._pack_tree_arrays(ids, names, common_names, ranks, edges)
 
-        # Start traversal from root
-        traverse(root_node)
-        return nodes, edges
+    @staticmethod
+    def build_plot_arrays(taxa_data: List[Dict]) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+        """
+        Build the node and edge arrays of create_tree_structure straight from
+        taxa data, without materializing the nested tree in between.
+
+        The result equals create_tree_structure(build_taxonomy_tree(taxa_data)):
+        nodes are matched by (parent node, taxon_id) as in build_taxonomy_tree,
+        and pre-order is recovered by sorting every node on its root path of
+        (rank, name, insertion order) sibling keys. Results are cached by
+        input content and the arrays are read-only.
+        """
+        return _cached_structure("taxa", taxa_data, TreeBuilder._build_plot_arrays)
 
     @staticmethod
-    def create_plotly_tree(hierarchy: Dict) -> go.Figure:
-        """Create an interactive phylogenetic tree visualization using Plotly."""
-        # Validate tree before visualization
-        if not TreeBuilder.validate_tree({"root": hierarchy}):
-            print("Warning: Tree validation failed before visualization")
+    def _build_plot_arrays(taxa_data: List[Dict]) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+        by_id = {t['taxon_id']: t for t in reversed(taxa_data)}
+        rank_index = RANK_ORDER.get
+
+        # Node 0 is the Life root that create_tree_structure hangs the forest under
+        records = [{'taxon_id': 48460, 'name': 'Life', 'rank': 'stateofmatter', 'common_name': ''}]
+        parent_of = [-1]
+        sort_path = [()]
+        node_of = {}
+        chain_ends = {}
+
+        def get_or_add_node(parent_node: int, data: Dict) -> int:
+            key = (parent_node, data['taxon_id'])
+            node = node_of.get(key)
+            if node is None:
+                node = node_of[key] = len(records)
+                records.append(data)
+                parent_of.append(parent_node)
+                sibling_key = (rank_index(data['rank'], 999), data['name'], node)
+                sort_path.append(sort_path[parent_node] + (sibling_key,))
+            return node
+
+        for taxon in taxa_data:
+            try:
+                chain = tuple(parse_ancestor_ids(taxon['ancestor_ids']))
+                if not chain:
+                    continue
+                end = chain_ends.get(chain)
+                if end is None:
+                    parent_node = 0
+                    for ancestor_id in chain:
+                        ancestor_data = by_id.get(ancestor_id)
+                        if ancestor_data:
+                            parent_node = get_or_add_node(parent_node, ancestor_data)
+                    end = chain_ends[chain] = parent_node
+                get_or_add_node(end, taxon)
+            except Exception as e:
+                logger.warning("Error processing taxon %s: %s", taxon.get('taxon_id', 'unknown'), e)
+
+        order = sorted(range(len(records)), key=sort_path.__getitem__)
+        index_of = [0] * len(records)
+        for i, node in enumerate(order):
+            index_of[node] = i
+
+        ordered = [records[node] for node in order]
+        return TreeBuilder._pack_tree_arrays(
+            [int(r['taxon_id']) for r in ordered],
+            [r['name'] for r in ordered],
+            [r.get('common_name', '') for r in ordered],
+            [r['rank'] for r in ordered],
+            [(index_of[parent_of[node]], i) for i, node in enumerate(order) if i]
+        )
+
+    @staticmethod
+    def _pack_tree_arrays(ids: List[int], names: List, common_names: List, ranks: List,
+                          edges: List[Tuple[int, int]]) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+        def object_array(values):
+            # np.array would try to broadcast nested values; fill explicitly
+            arr = np.empty(len(values), dtype=object)
+            arr[:] = values
+            return arr
+
+        nodes = {
+            "ids": np.array(ids, dtype=np.int64),
+            "names": object_array(names),
+            "common_names": object_array(common_names),
+            "ranks": object_array(ranks),
+        }
+        return nodes, np.array(edges, dtype=np.int32).reshape(-1, 2)
+
+    @staticmethod
+    def create_plotly_tree(hierarchy: Union[Dict, List[Dict]], validate: bool = False) -> go.Figure:
+        """
+        Create an interactive phylogenetic tree visualization using Plotly.
+        Pass validate=True to check node fields first (an extra tree walk).
+        """
+        if validate:
+            if isinstance(hierarchy, list):
+                valid = TreeBuilder.validate_tree(hierarchy)
+            else:
+                valid = TreeBuilder._validate_node(hierarchy)
+            if not valid:
+                logger.warning("Tree validation failed before visualization")
 
         nodes, edges = TreeBuilder.create_tree_structure(hierarchy)
+        return TreeBuilder._plot_tree_arrays(nodes, edges)
 
-        # Build graph structure
-        G = {i: [] for i in nodes.keys()}
-        for parent, child in edges:
-            G[parent].append(child)
-
-        # Calculate positions
-        pos = {}
-
-        def get_leaf_count(node_id):
-            children = G[node_id]
-            if not children:
-                return 1
-            return sum(get_leaf_count(child) for child in children)
-
-        def calculate_positions(node_id, x=0, y_start=0, vertical_spacing=1):
-            """
-            Recursively assign (x, y) for each node.
-
-            :param node_id: the ID in the BFS index, not the taxon_id
-            :param x: current x-level
-            :param y_start: the y-value to start placing children
-            :param vertical_spacing: how far apart to place children
-            :return: the updated y after placing this node and its children
-            """
-            children = G[node_id]
-
-            if not children:
-                # Leaf node
-                pos[node_id] = (x, y_start)
-                return y_start + vertical_spacing
-
-            current_y = y_start
-            child_x = x + 1
-
-            child_y_positions = []
-            for child in children:
-                next_y = calculate_positions(child, child_x, current_y, vertical_spacing)
-                child_y_positions.append(pos[child][1])
-                current_y = next_y
-
-            # Position the parent in the middle of its children
-            pos[node_id] = (x, sum(child_y_positions) / len(child_y_positions))
-            return current_y
-
-        # 1) Count total leaves
-        leaf_count = get_leaf_count(0)
+    @staticmethod
+    def create_plotly_tree_from_taxa(taxa_data: List[Dict]) -> go.Figure:
+        """Plot taxa data directly; same figure as create_plotly_tree(build_taxonomy_tree(taxa_data))."""
+        nodes, edges = TreeBuilder.build_plot_arrays(taxa_data)
+        return TreeBuilder._plot_tree_arrays(nodes, edges)
+
+    @staticmethod
+    def _plot_tree_arrays(nodes: Dict[str, np.ndarray], edges: np.ndarray) -> go.Figure:
+        """Lay out and draw the pre-order node/edge arrays of create_tree_structure."""
+        names = nodes["names"]
+        common_names = nodes["common_names"]
+        ranks = nodes["ranks"]
+
+        # Build graph structure. create_tree_structure numbers nodes in
+        # pre-order, so every parent ID is smaller than its children's IDs and
+        # leaves appear in depth-first order when read by increasing ID.
+        n = len(names)
+        parents, children = edges[:, 0], edges[:, 1]
+
+        # 1) CSR adjacency: children of node i are indices[indptr[i]:indptr[i + 1]].
+        #    The stable sort keeps each node's children in pre-order.
+        indptr = np.zeros(n + 1, dtype=np.int32)
+        indptr[1:] = np.cumsum(np.bincount(parents, minlength=n))
+        indices = children[np.argsort(parents, kind="stable")]
 
         # 2) Multiply the base spacing by a bigger factor to get more vertical space
         #    For example, we used 2.0 in your code; let's double it to 4.0
+        leaf_count = np.count_nonzero(indptr[1:] == indptr[:-1])
         vertical_spacing = 4.0 / (leaf_count + 1)
 
-        # 3) Run the position calculation
-        calculate_positions(0, vertical_spacing=vertical_spacing)
+        # 3) Depth gives x; leaves are stacked and parents centred for y
+        xpos, ypos = _layout(indptr, indices, vertical_spacing)
 
         # Create figure
         fig = go.Figure()
 
-        # Add edges (branches)
-        for parent, child in edges:
-            px, py = pos[parent]
-            cx, cy = pos[child]
-
-            # Create L-shaped branches
-            path_x = [px, px, cx]
-            path_y = [py, cy, cy]
-
-            fig.add_trace(go.Scatter(
-                x=path_x,
-                y=path_y,
-                mode="lines",
-                line=dict(color="#2E7D32", width=1),
-                hoverinfo="skip",
-                showlegend=False
-            ))
-
-        # Add nodes and labels
-        for node_id, node_info in nodes.items():
-            x, y = pos[node_id]
-            rank = node_info.get("rank", "")
-            name = node_info.get("name", "")
-            common_name = node_info.get("common_name", "")
-
-            # Create hover text
+        # Add edges (branches) as a single trace of L-shaped segments,
+        # (px, py) -> (px, cy) -> (cx, cy); NaN breaks the line between
+        # consecutive segments.
+        # One row per edge; each coordinate array is gathered only once.
+        edge_x = np.empty((len(edges), 4), dtype=np.float32)
+        edge_y = np.empty((len(edges), 4), dtype=np.float32)
+        edge_x[:, :2] = xpos[parents, None]
+        edge_x[:, 2] = xpos[children]
+        edge_x[:, 3] = np.nan
+        edge_y[:, 0] = ypos[parents]
+        edge_y[:, 1:3] = ypos[children, None]
+        edge_y[:, 3] = np.nan
+
+        fig.add_trace(go.Scattergl(
+            x=edge_x.ravel(),
+            y=edge_y.ravel(),
+            mode="lines",
+            line=dict(color="#2E7D32", width=1),
+            hoverinfo="skip",
+            showlegend=False
+        ))
+
+        # Hover text for every node, then one mask partitions all node
+        # arrays into higher taxa and species.
+        hover = np.empty(n, dtype=object)
+        rank_titles = {}
+        for i, (name, common_name, rank) in enumerate(zip(names, common_names, ranks)):
             hover_text = f"{name}"
             if common_name:
                 hover_text += f"<br>{common_name}"
             if rank:
-                hover_text += f"<br>{rank.title()}"
-
-            # Determine if this is a leaf node (species)
-            is_leaf = (rank == "species")
-
-            # Add node
-            fig.add_trace(go.Scatter(
-                x=[x],
-                y=[y],
-                mode="markers" + ("+text" if is_leaf else ""),
-                marker=dict(
-                    size=8 if is_leaf else 6,
-                    color="#2E7D32"
-                ),
-                text=[name] if is_leaf else None,
-                textposition="middle right" if is_leaf else None,
-                hoverinfo="text",
-                hovertext=hover_text,
-                showlegend=False
-            ))
+                title = rank_titles.get(rank)
+                if title is None:
+                    title = rank_titles[rank] = rank.title()
+                hover_text += f"<br>{title}"
+            hover[i] = hover_text
+
+        # Leaf nodes (species) also get a text label. The index lists are
+        # computed once and reused by every gather, instead of re-scanning a
+        # boolean mask for each array.
+        is_species = ranks == "species"
+        species_idx = np.flatnonzero(is_species)
+        higher_idx = np.flatnonzero(~is_species)
+
+        # Unlabelled markers render through WebGL; species stay on SVG
+        # Scatter, whose text labels are more reliable than Scattergl's.
+        fig.add_trace(go.Scattergl(
+            x=xpos[higher_idx],
+            y=ypos[higher_idx],
+            mode="markers",
+            marker=dict(size=6, color="#2E7D32"),
+            hoverinfo="text",
+            hovertext=hover[higher_idx],
+            showlegend=False
+        ))
+        fig.add_trace(go.Scatter(
+            x=xpos[species_idx],
+            y=ypos[species_idx],
+            mode="markers+text",
+            marker=dict(size=8, color="#2E7D32"),
+            text=names[species_idx],
+            textposition="middle right",
+            hoverinfo="text",
+            hovertext=hover[species_idx],
+            showlegend=False
+        ))
 
         # Update layout
+        x_min, x_max = float(xpos.min()), float(xpos.max())
         fig.update_layout(
             showlegend=False,
             plot_bgcolor="white",
@@ -335,10 +548,7 @@ class TreeBuilder:
                 showgrid=False,
                 zeroline=False,
                 showticklabels=False,
-                range=[
-                    min(x for x, _ in pos.values()) - 0.5,
-                    max(x for x, _ in pos.values()) + 2
-                ]
+                range=[x_min - 0.5, x_max + 2]
             ),
             # Removing scaleanchor so y can stretch more
             yaxis=dict(